@@ -1,16 +1,37 @@
-import json
-import numpy as np
+import hashlib
+import orjson
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import requests
 from dotenv import load_dotenv
-from scipy.stats import linregress
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+load_dotenv()
+
+_BASE_HEADERS = {
+    'version': '4.7',
+    'product': 'llu.ios',
+    'Accept': 'application/json',
+    'Content-Type': 'application/json'
+}
+_CREDENTIALS = orjson.dumps(
+    {
+        "email": os.getenv('email'),
+        "password": os.getenv('password')
+    }
+)
+_ACCOUNT_HASH = hashlib.sha256((os.getenv('email') or '').encode()).hexdigest()
 
 
 class LibreDataHandler:
-    load_dotenv()
     MGID = os.getenv("MGID")
     SGID = os.getenv("SGID")
     DESTINATION = os.getenv("DESTINATION")
+    TOKEN_FILE = os.path.expanduser(os.getenv("TOKEN_FILE", "~/.libre_token"))
     BASE_URL = 'https://api-us.libreview.io/'
     URLs = {
         "login": BASE_URL + 'llu/auth/login',
@@ -23,16 +44,29 @@ class LibreDataHandler:
 
     def __init__(self):
         self.session = requests.Session()
-        self.glucose_data = dict()
+        self.dest_session = requests.Session()
+        self.dest_session.headers.update({'Content-Type': 'application/json'})
+        self.graph_values = []
+        self.glucose_item = None
         self.bearer_token = None
         self.account_info = None
         self.libre_connections = None
         self.logbook = None
         self.tou_response = None
-        self.auth_data = self._load_credentials()
-        self.headers = self._build_headers
-        auth_response = self._post(self.URLs['login'], data=self.auth_data)
-        self.add_bearer_token_to_headers(auth_response['data']['authTicket']['token'])
+        self._validators = dict()
+        self._resp_cache = dict()
+        self.auth_data = _CREDENTIALS
+        self._login_lock = threading.Lock()
+        retry = Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'POST'])
+        )
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=20, max_retries=retry))
+        self.session.headers.update(_BASE_HEADERS)
+        if not self._load_cached_token():
+            self._login()
 
     def __enter__(self):
         """
@@ -50,45 +84,104 @@ class LibreDataHandler:
         :return: None
         """
         self.session.close()
+        self.dest_session.close()
         print("Closing up http session")
 
-    @staticmethod
-    def _load_credentials():
+    def add_bearer_token_to_headers(self, token):
         """
-        Load the credentials from environment variables.
+        Adds a bearer token to the session headers.
 
-        :return: The credentials as a JSON string.
+        :param token: The bearer token to add.
+        :return: None
         """
-        return json.dumps(
-            {
-                "email": os.getenv('email'),
-                "password": os.getenv('password')
-            }
-        )
+        self.bearer_token = token
+        self.session.headers['Authorization'] = f"Bearer {token}"
 
-    @property
-    def _build_headers(self):
+    def _load_cached_token(self):
         """
-        Returns the headers dictionary used for HTTP requests.
+        Loads the bearer token cached by a previous run, if it is still valid and belongs to
+        the configured account.
 
-        :return: A dictionary containing the headers for the HTTP requests.
-        :rtype: dict
+        :return: True if a cached token was installed, False otherwise.
         """
-        return {
-            'version': '4.7',
-            'product': 'llu.ios',
-            'Accept': 'application/json',
-            'Content-Type': 'application/json'
-        }
+        try:
+            with open(self.TOKEN_FILE, 'rb') as f:
+                cached = orjson.loads(f.read())
+            if cached.get('account') != _ACCOUNT_HASH or cached.get('exp', 0) <= time.time() + 60:
+                return False
+            token = cached['token']
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return False
+        self.add_bearer_token_to_headers(token)
+        return True
+
+    def _save_token(self, token, expires):
+        """
+        Atomically writes the bearer token, its expiry and the account hash to the token file.
 
-    def add_bearer_token_to_headers(self, token):
+        :param token: The bearer token to cache.
+        :param expires: The token expiry as a Unix timestamp.
+        :return: None
         """
-        Adds a bearer token to the headers.
+        tmp_file = f"{self.TOKEN_FILE}.tmp"
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(orjson.dumps({'token': token, 'exp': expires, 'account': _ACCOUNT_HASH}))
+            os.replace(tmp_file, self.TOKEN_FILE)
+        except OSError:
+            pass
+
+    def _clear_cached_token(self):
+        """
+        Removes the cached bearer token file, if present.
 
-        :param token: The bearer token to add.
         :return: None
         """
-        self.headers['Authorization'] = f"Bearer {token}"
+        try:
+            os.remove(self.TOKEN_FILE)
+        except OSError:
+            pass
+
+    def _login(self):
+        """
+        Logs in with the configured credentials and installs and caches the bearer token.
+
+        :return: None
+        """
+        response = self._request(
+            'POST', self.URLs['login'], reauth=False, data=self.auth_data, headers={'Authorization': None}
+        )
+        auth_ticket = orjson.loads(response.content)['data']['authTicket']
+        self.add_bearer_token_to_headers(auth_ticket['token'])
+        if 'expires' in auth_ticket:
+            self._save_token(auth_ticket['token'], auth_ticket['expires'])
+
+    def _request(self, method, url, reauth=True, **kwargs):
+        """
+        Sends an HTTP request over the Libre session.
+
+        A 401 response is treated as an expired token: the cached token is dropped, a fresh
+        login is performed and the request is retried once. Logins are serialised, and skipped
+        if another thread already replaced the token this request was sent with.
+
+        :param method: The HTTP method to use.
+        :param url: The URL to send the request to.
+        :param reauth: Whether to log in again and retry once on a 401 response.
+        :param kwargs: Extra arguments passed on to the session.
+        :return: The response object.
+        """
+        token = self.bearer_token
+        response = self.session.request(method, url, **kwargs)
+        if response.status_code == 401 and reauth:
+            response.close()
+            with self._login_lock:
+                if self.bearer_token == token:
+                    self._clear_cached_token()
+                    self._login()
+            response = self.session.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
 
     def _post(self, url, data=None):
         """
@@ -98,34 +191,80 @@ class LibreDataHandler:
         :param data: Optional data to be sent with the POST request.
         :return: The JSON response from the POST request.
         """
-        print()
-        response = self.session.post(url, headers=self.headers, data=data)
-        response.raise_for_status()
-        return response.json()
+        return orjson.loads(self._request('POST', url, data=data).content)
 
     def _get(self, url):
         """
             Send HTTP GET request to the specified URL and return the response as a JSON object.
 
+            The request is conditional when a previous response carried an ETag or Last-Modified
+            header; on 304 Not Modified the previously decoded object is returned.
+
             :param url: The URL to send the GET request to.
             :return: The response as a JSON object.
         """
-        response = self.session.get(url, headers=self.headers)
-        response.raise_for_status()
-        return response.json()
+        response = self._request('GET', url, headers=self._validators.get(url))
+        if response.status_code == 304:
+            return self._resp_cache[url]
+        data = orjson.loads(response.content)
+        self._cache_response(url, response, data)
+        return data
+
+    def _cache_response(self, url, response, data):
+        """
+        Remembers the response validators and decoded data for conditional GETs of the URL.
+
+        :param url: The URL the response was fetched from.
+        :param response: The response object.
+        :param data: The decoded data to return when the server replies 304 Not Modified.
+        :return: None
+        """
+        validators = dict()
+        if 'ETag' in response.headers:
+            validators['If-None-Match'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            validators['If-Modified-Since'] = response.headers['Last-Modified']
+        if validators:
+            self._validators[url] = validators
+            self._resp_cache[url] = data
+        else:
+            self._validators.pop(url, None)
+            self._resp_cache.pop(url, None)
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _graph_url(account):
+        """
+        :param account: The account identifier.
+        :return: The graph URL for the account, formatted once and cached.
+        """
+        return LibreDataHandler.URLs['graph'].format(USERID=account)
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _logbook_url(account):
+        """
+        :param account: The account identifier.
+        :return: The logbook URL for the account, formatted once and cached.
+        """
+        return LibreDataHandler.URLs['logbook'].format(USERID=account)
 
     def _calculate_trend(self):
         """:return: The trend of the glucose data.
 
             The trend is calculated by fitting a linear regression line to the last 10 glucose data points.
+            Only the sign of the slope matters, so just its numerator is computed.
             If the slope of the line is positive, the trend is classified as "up".
             If the slope of the line is negative, the trend is classified as "down".
             If the slope of the line is zero, the trend is classified as "steady".
         """
-        graph_data = self.glucose_data['data']['graphData']
-        series = graph_data[-10::] if len(graph_data) > 9 else graph_data
-        trend = [x['Value'] for x in series]
-        slope, _, _, _, _ = linregress(np.arange(len(trend)), trend)
+        n = sx = sy = sxy = 0
+        for i, y in enumerate(self.graph_values):
+            n += 1
+            sx += i
+            sy += y
+            sxy += i * y
+        slope = n * sxy - sx * sy
         return "up" if slope > 0 else "down" if slope < 0 else "steady"
 
     def accept_tou(self):
@@ -148,12 +287,17 @@ class LibreDataHandler:
         """
         Retrieves the glucose data graph for the specified account.
 
+        Only the last 10 graph values and the current glucose item are kept, not the full
+        response.
+
         :param account: The account for which to retrieve the graph.
         :type account: str
         :return: None
         :rtype: None
         """
-        self.glucose_data = self._get(self.URLs['graph'].format(USERID=account))
+        data = self._get(self._graph_url(account))['data']
+        self.graph_values = [point['Value'] for point in data['graphData'][-10:]]
+        self.glucose_item = data['connection']['glucoseItem']
 
     def get_connections(self):
         """
@@ -169,7 +313,42 @@ class LibreDataHandler:
         :return: None
 
         """
-        self.logbook = self._get(self.URLs['logbook'].format(USERID=account))
+        self.logbook = self._get(self._logbook_url(account))
+
+    def fetch_all(self, account):
+        """
+        Retrieves the graph, logbook and account information concurrently using a thread pool.
+
+        :param account: The account for which to retrieve the graph and logbook.
+        :type account: str
+        :return: None
+        """
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [
+                executor.submit(self.get_graph, account),
+                executor.submit(self.get_logbook, account),
+                executor.submit(self.get_account)
+            ]
+        for future in futures:
+            future.result()
+
+    async def fetch_all_async(self, account):
+        """
+        Retrieves the graph, logbook and account information concurrently.
+
+        Each call runs in a worker thread against the shared, pooled session, so the total
+        wait is roughly that of the slowest request rather than the sum of all three.
+
+        :param account: The account for which to retrieve the graph and logbook.
+        :type account: str
+        :return: None
+        """
+        import asyncio
+        await asyncio.gather(
+            asyncio.to_thread(self.get_graph, account),
+            asyncio.to_thread(self.get_logbook, account),
+            asyncio.to_thread(self.get_account)
+        )
 
     @staticmethod
     def print_glucose(data):
@@ -193,7 +372,7 @@ class LibreDataHandler:
 
         :return: None
         """
-        glucose_item = self.glucose_data['data']['connection']['glucoseItem']
+        glucose_item = self.glucose_item
         glucose_item['Trend'] = self._calculate_trend()
         data = {
             'time': glucose_item['Timestamp'],
@@ -201,11 +380,22 @@ class LibreDataHandler:
             'trend': glucose_item['Trend']
         }
         self.print_glucose(data)
-        response = requests.post(self.DESTINATION, data=json.dumps(data))
+        response = self.dest_session.post(self.DESTINATION, data=orjson.dumps(data))
         response.raise_for_status()
 
 
 if __name__ == "__main__":
+    poll_interval = os.getenv("POLL_INTERVAL")
+    poll_interval = int(poll_interval) if poll_interval else None
     with LibreDataHandler() as libre:
-        libre.get_graph(libre.SGID)
-        libre.send_glucose_data()
+        if poll_interval is None:
+            libre.get_graph(libre.SGID)
+            libre.send_glucose_data()
+        else:
+            while True:
+                try:
+                    libre.get_graph(libre.SGID)
+                    libre.send_glucose_data()
+                except requests.RequestException as e:
+                    print(f"Error sending glucose data: {e}")
+                time.sleep(poll_interval)